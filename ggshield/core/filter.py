@@ -3,6 +3,7 @@ import math
 import operator
 import re
 from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path, PurePosixPath
 from typing import Dict, Iterable, List, Optional, Set
 
@@ -164,12 +165,19 @@ def init_exclusion_regexes(paths_ignore: Iterable[str]) -> Set[re.Pattern]:
     files in .git
     files ignore in .gitignore
     """
-    res = set()
-    for path in paths_ignore:
-        if not is_pattern_valid(path):
-            raise UsageError(f"{path} is not a valid exclude pattern.")
-        res.add(re.compile(translate_user_pattern(path)))
-    return res
+    return {_compile_exclusion_regex(path) for path in paths_ignore}
+
+
+@lru_cache(None)
+def _compile_exclusion_regex(path: str) -> re.Pattern:
+    """
+    Validates and compiles an exclusion pattern. Cached because the same patterns,
+    such as IGNORED_DEFAULT_WILDCARDS, are compiled each time the --exclude option
+    is processed.
+    """
+    if not is_pattern_valid(path):
+        raise UsageError(f"{path} is not a valid exclude pattern.")
+    return re.compile(translate_user_pattern(path))
 
 
 def is_filepath_excluded(filepath: str, exclusion_regexes: Set[re.Pattern]) -> bool:
@@ -101,30 +101,30 @@ class Scannable(ABC):
 
         Raises DecodeError if the file cannot be decoded.
         """
-        byte_content = b""
-        str_content = ""
-
-        charset_matches = charset_normalizer.from_fp(fp)
-        charset_match = charset_matches.best()
+        # charset_normalizer.from_fp() reads the whole file: read it ourselves and
+        # reuse the bytes, instead of seeking back and reading the file a second time
+        byte_content = fp.read()
+        charset_match = charset_normalizer.from_bytes(byte_content).best()
         if charset_match is None:
             raise DecodeError
-        fp.seek(0)
-        while True:
-            # Try to read more than the requested size:
-            # - If the file is smaller, that changes nothing
-            # - if the file is bigger, we potentially avoid a second read
-            byte_chunk = fp.read(size * 2)
-            if byte_chunk:
-                byte_content += byte_chunk
-                # Note: we decode `byte_content` and not `byte_chunk`: we can't
-                # decode just the chunk because we have no way to know if it starts
-                # and ends at complete code-point boundaries
-                str_content = Scannable._decode_bytes(byte_content, charset_match)
-                if len(str_content) > size:
-                    return True, None
-            else:
-                # We read the whole file, keep it
-                return False, str_content
+
+        str_content = ""
+        # Decode more than the requested size at each step:
+        # - If the file is smaller, that changes nothing
+        # - if the file is bigger, we potentially avoid decoding all of it
+        # (range() does not accept a step of 0, hence the max())
+        step = max(size * 2, 1)
+        for chunk_end in range(step, len(byte_content) + step, step):
+            # Note: we decode from the start of `byte_content` and not just the last
+            # chunk: we can't decode just the chunk because we have no way to know if
+            # it starts and ends at complete code-point boundaries
+            str_content = Scannable._decode_bytes(
+                byte_content[:chunk_end], charset_match
+            )
+            if len(str_content) > size:
+                return True, None
+        # We decoded the whole file, keep it
+        return False, str_content
 
 
 class StringScannable(Scannable):
@@ -1,14 +1,20 @@
+import concurrent.futures
+import itertools
 import json
 import os.path
+import queue
 import re
 import subprocess
 import tarfile
+import threading
+from contextlib import closing
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Set
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Set, cast
 
 from click import UsageError
 from pygitguardian import GGClient
+from pygitguardian.config import MULTI_DOCUMENT_LIMIT
 
 from ggshield.core.cache import Cache
 from ggshield.core.dirs import get_cache_dir
@@ -16,53 +22,125 @@ from ggshield.core.errors import UnexpectedError
 from ggshield.core.file_utils import is_path_binary
 from ggshield.core.text_utils import display_heading, display_info
 from ggshield.core.types import IgnoredMatch
-from ggshield.scan import Files, ScanContext, Scannable, StringScannable
+from ggshield.scan import ScanContext, Scannable, StringScannable
 from ggshield.scan.id_cache import IDCache
 
 from .rich_secret_scanner_ui import RichSecretScannerUI
-from .secret_scan_collection import SecretScanCollection
+from .secret_scan_collection import Results, SecretScanCollection
 from .secret_scanner import SecretScanner
 
 
-FILEPATH_BANLIST = [
-    r"^/?usr/(?!share/nginx)",
-    r"^/?lib/",
-    r"^/?share/",
-    r"^/?bin/",
-    r"^/?sbin/",
-    r"^/?node_modules/",
-    r"^/?include/",
-    r"^/?vendor/",
-    r"^/?texlive/",
-    r"^/?var/",
-    r"^/?fonts/",
-    r"^/?npm/",
-    r"^/?site-packages/",
-]
-FILEPATH_BANLIST_PATTERNS = {
-    re.compile(banned_filepath) for banned_filepath in FILEPATH_BANLIST
-}
-
-LAYER_TO_SCAN_PATTERN = re.compile(r"\b(copy|add)\b", re.IGNORECASE)
+# Files whose path starts with one of these prefixes are not scanned. Paths are
+# relative to the root of the image. These are plain prefixes, not regexes: checking
+# them with `str.startswith()` is much faster than running a regex on every file of
+# every layer.
+FILEPATH_BANLIST = (
+    "usr/",
+    "lib/",
+    "share/",
+    "bin/",
+    "sbin/",
+    "node_modules/",
+    "include/",
+    "vendor/",
+    "texlive/",
+    "var/",
+    "fonts/",
+    "npm/",
+    "site-packages/",
+)
+
+# Exceptions to FILEPATH_BANLIST
+FILEPATH_BANLIST_EXCEPTIONS = ("usr/share/nginx",)
+
+# A layer is scanned if its lower-cased command contains one of these. Commands look
+# like "COPY foo /bar # buildkit" or "/bin/sh -c #(nop) ADD file:xxx in /".
+LAYER_TO_SCAN_KEYWORDS = (" copy ", " add ", " copy\t", " add\t")
 
 TAG_PATTERN = re.compile(r":[a-zA-Z0-9_][-.a-zA-Z0-9_]{0,127}$")
 
+# An archive this small holds only its end-of-archive marker: two zero blocks
+EMPTY_TAR_SIZE = 2 * tarfile.BLOCKSIZE
+
+# Maximum number of layer files waiting to be scanned. Files in the queue have not
+# been read yet: this bounds the number of TarInfo kept when walking layers is faster
+# than scanning them.
+FILE_QUEUE_SIZE = 256
+
+# How long, in seconds, the layer walker waits for room in the file queue before
+# checking if it must stop
+QUEUE_PUT_TIMEOUT = 0.1
+
+# Maximum number of layer files sent to a single SecretScanner.scan() call. scan()
+# keeps all its files, and their content, until it returns, so scanning in batches
+# bounds memory usage. This is 2 API requests for each of the default 4 scan threads.
+SCAN_BATCH_SIZE = 8 * MULTI_DOCUMENT_LIMIT
+
 
 class InvalidDockerArchiveException(Exception):
     pass
 
 
+class LayerArchives:
+    """
+    Reads layer files of a Docker image through its own handle on the image archive.
+
+    Layer archives are walked from another thread than the one reading the files, and
+    reading a member of a TarFile moves the file pointer of the underlying file, so
+    the TarFile used for the walk cannot be used to read files. The handle is opened
+    on first use, and a TarFile is cached for each layer.
+    """
+
+    def __init__(self, archive_path: str):
+        self._archive_path = archive_path
+        self._archive: Optional[tarfile.TarFile] = None
+        self._layer_archives: Dict[str, tarfile.TarFile] = {}
+
+    def extractfile(
+        self, layer_tar_info: tarfile.TarInfo, tar_info: tarfile.TarInfo
+    ) -> IO[bytes]:
+        """
+        Returns a file object for the `tar_info` member of the layer archive stored in
+        the `layer_tar_info` member of the image archive
+        """
+        layer_archive = self._layer_archives.get(layer_tar_info.name)
+        if layer_archive is None:
+            if self._archive is None:
+                self._archive = tarfile.open(self._archive_path)
+            # Passing a TarInfo to extractfile() seeks directly to the layer archive,
+            # without scanning the member list of the image archive
+            layer_archive = tarfile.TarFile(
+                fileobj=self._archive.extractfile(layer_tar_info)
+            )
+            self._layer_archives[layer_tar_info.name] = layer_archive
+
+        fp = layer_archive.extractfile(tar_info)
+        assert fp is not None
+        return fp
+
+    def close(self) -> None:
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+        self._layer_archives.clear()
+
+
 class DockerContentScannable(Scannable):
     """
     A Scannable for a file inside a Docker image
     """
 
     def __init__(
-        self, layer_id: str, tar_file: tarfile.TarFile, tar_info: tarfile.TarInfo
+        self,
+        layer_id: str,
+        layer_archives: LayerArchives,
+        layer_tar_info: tarfile.TarInfo,
+        tar_info: tarfile.TarInfo,
     ):
         super().__init__()
         self._layer_id = layer_id
-        self._tar_file = tar_file
+        self._layer_archives = layer_archives
+        self._layer_tar_info = layer_tar_info
         self._tar_info = tar_info
         self._content: Optional[str] = None
 
@@ -70,6 +148,10 @@ class DockerContentScannable(Scannable):
     def url(self) -> str:
         return f"{self._layer_id}:/{self._tar_info.name}"
 
+    @property
+    def layer_id(self) -> str:
+        return self._layer_id
+
     @property
     def filename(self) -> str:
         return self.url
@@ -88,11 +170,17 @@ class DockerContentScannable(Scannable):
             # decoded size will be smaller
             return False
 
+        if self._tar_info.size > size * 4 + 4:
+            # Shortcut: a character takes at most 4 bytes in the encodings we detect,
+            # and a BOM at most 4 more bytes, so we can be sure the decoded size will
+            # be bigger. This avoids decoding big files only to skip them.
+            # (UTF-7 can exceed 4 bytes per character, but only for text made almost
+            # entirely of characters outside the Basic Multilingual Plane)
+            return True
+
         # We need to decode at least the beginning of the file to determine if it's
         # small enough
-        fp = self._tar_file.extractfile(self._tar_info)
-        assert fp is not None
-        with fp:
+        with self._extractfile() as fp:
             result, self._content = Scannable._is_file_longer_than(
                 fp, size  # type:ignore
             )
@@ -103,33 +191,40 @@ class DockerContentScannable(Scannable):
     @property
     def content(self) -> str:
         if self._content is None:
-            file = self._tar_file.extractfile(self._tar_info)
-            assert file is not None
-            byte_content = file.read()
+            with self._extractfile() as file:
+                byte_content = file.read()
             self._content = Scannable._decode_bytes(byte_content)
         return self._content
 
+    def _extractfile(self) -> IO[bytes]:
+        return self._layer_archives.extractfile(self._layer_tar_info, self._tar_info)
+
 
 @dataclass
 class LayerInfo:
     filename: str
     command: str
     diff_id: str
+    # Member of the image archive containing the layer archive
+    tar_info: tarfile.TarInfo
 
-    def should_scan(self) -> bool:
-        """
-        Returns True if a layer should be scanned, False otherwise.
-        Only COPY and ADD layers should be scanned.
-        """
-        if self.command == "":
-            # Some images contain layers with no commands. Since we don't know how they have
-            # been created, we must scan them.
-            # Examples of such images from Docker Hub:
-            # - aevea/release-notary:0.9.7
-            # - redhat/ubi8:8.6-754
-            return True
-        else:
-            return LAYER_TO_SCAN_PATTERN.search(self.command) is not None
+
+def _should_scan_layer_command(command: str) -> bool:
+    """
+    Returns True if a layer created by `command` should be scanned, False otherwise.
+    Only COPY and ADD layers should be scanned.
+    """
+    if command == "":
+        # Some images contain layers with no commands. Since we don't know how they have
+        # been created, we must scan them.
+        # Examples of such images from Docker Hub:
+        # - aevea/release-notary:0.9.7
+        # - redhat/ubi8:8.6-754
+        return True
+    else:
+        # Prefix the command with a space so that keywords also match at the start
+        command = " " + command.lower()
+        return any(keyword in command for keyword in LAYER_TO_SCAN_KEYWORDS)
 
 
 class DockerImage:
@@ -144,19 +239,25 @@ class DockerImage:
 
     def __init__(self, tar_file: tarfile.TarFile):
         self.tar_file = tar_file
+        self._layer_archives: Optional[LayerArchives] = None
         self._load_manifest()
 
         self._load_image()
 
+        # One value per line keeps reported secret locations readable, but
+        # indentation would only make the document bigger
         self.config_scannable = StringScannable(
-            "Dockerfile or build-args", json.dumps(self.image, indent=2)
+            "Dockerfile or build-args", json.dumps(self.image, indent=0)
         )
 
         self._load_layer_infos()
 
-    def get_layer(self, layer_info: LayerInfo) -> Files:
-        scannables = list(self._get_layer_scannables(layer_info))
-        return Files(scannables)
+    def close(self) -> None:
+        """
+        Closes the archive handle opened to read the content of layer files
+        """
+        if self._layer_archives is not None:
+            self._layer_archives.close()
 
     def _load_manifest(self) -> None:
         """
@@ -177,6 +278,8 @@ class DockerImage:
         except KeyError:
             raise InvalidDockerArchiveException("No Config key in manifest.")
 
+        # Pass the TarInfo to extractfile() rather than the path: given a path,
+        # extractfile() has to look the member up again
         config_file_info = self.tar_file.getmember(config_file_path)
         if config_file_info is None:
             raise InvalidDockerArchiveException("No config file found.")
@@ -212,31 +315,47 @@ class DockerImage:
         # image["rootfs"]["diff_ids"] contains the list of layer IDs
         diff_ids = self.image["rootfs"]["diff_ids"]
 
-        layer_infos = [
+        # Filter layers before creating LayerInfo instances, so that we do not look up
+        # the archive members of layers we are not going to scan
+        self.layer_infos = [
             LayerInfo(
                 filename=filename,
-                command=history.get("created_by", ""),
+                command=command,
                 diff_id=diff_id,
+                tar_info=self.tar_file.getmember(filename),
             )
-            for filename, history, diff_id in zip(
-                layer_filenames, non_empty_history_entries, diff_ids
+            for filename, command, diff_id in zip(
+                layer_filenames,
+                (x.get("created_by", "") for x in non_empty_history_entries),
+                diff_ids,
             )
+            if _should_scan_layer_command(command)
         ]
-        self.layer_infos = [x for x in layer_infos if x.should_scan()]
 
-    def _get_layer_scannables(self, layer_info: LayerInfo) -> Iterable[Scannable]:
+    def iter_layer_files(
+        self, layer_info: LayerInfo
+    ) -> Iterator[DockerContentScannable]:
         """
-        Extracts Scannable to be scanned for given layer.
+        Yields the Scannable to be scanned for given layer, as its archive is walked.
         """
-        layer_filename = layer_info.filename
+        layer_tar_info = layer_info.tar_info
+        if layer_tar_info.isfile() and layer_tar_info.size <= EMPTY_TAR_SIZE:
+            # The layer archive cannot contain any member, no need to open it. Only
+            # regular members are checked: older versions of `docker save` store
+            # duplicated layers as links, whose size is 0.
+            return
+
         layer_archive = tarfile.TarFile(
-            name=os.path.join(self.tar_file.name, layer_filename),  # type: ignore
-            fileobj=self.tar_file.extractfile(layer_filename),
+            name=os.path.join(self.tar_file.name, layer_info.filename),  # type: ignore
+            fileobj=self.tar_file.extractfile(layer_tar_info),
         )
 
+        if self._layer_archives is None:
+            self._layer_archives = LayerArchives(self.tar_file.name)  # type: ignore
+
         layer_id = layer_info.diff_id
 
-        for file_info in layer_archive:
+        for file_info in _iter_tar_members(layer_archive):
             if not file_info.isfile():
                 continue
 
@@ -246,14 +365,34 @@ class DockerImage:
             if not _validate_filepath(filepath=file_info.path):
                 continue
 
-            yield DockerContentScannable(layer_id, layer_archive, file_info)
+            yield DockerContentScannable(
+                layer_id, self._layer_archives, layer_tar_info, file_info
+            )
+
+
+def _iter_tar_members(tar_file: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    """
+    Like iterating on `tar_file`, but without keeping the members in memory.
+
+    TarFile already reads member headers one at a time while it is iterated, but it
+    also appends each of them to its member list. Layers are walked only once, so this
+    list is useless, and for layers with hundreds of thousands of files it grows to
+    tens of MiB.
+    """
+    while True:
+        tar_info = tar_file.next()
+        if tar_info is None:
+            return
+        tar_file.members.clear()  # type: ignore
+        yield tar_info
 
 
 def _validate_filepath(
     filepath: str,
 ) -> bool:
-    if any(
-        banned_pattern.search(filepath) for banned_pattern in FILEPATH_BANLIST_PATTERNS
+    relative_path = filepath.lstrip("/")
+    if relative_path.startswith(FILEPATH_BANLIST) and not relative_path.startswith(
+        FILEPATH_BANLIST_EXCEPTIONS
     ):
         return False
 
@@ -262,6 +401,94 @@ def _validate_filepath(
     return True
 
 
+def _walk_layers(
+    docker_image: DockerImage,
+    layer_infos: List[LayerInfo],
+    file_queue: "queue.Queue[Optional[Scannable]]",
+    ui: RichSecretScannerUI,
+    scanned_layer_ids: Set[str],
+    stop_event: threading.Event,
+) -> None:
+    """
+    Walks the archives of `layer_infos`, pushing their files to `file_queue`. The
+    queue ends with None. Stops early if `stop_event` is set.
+
+    Fills `scanned_layer_ids` with the IDs of the layers which have files to scan.
+    """
+    try:
+        for info in layer_infos:
+            if stop_event.is_set():
+                return
+            file_count = 0
+            for scannable in docker_image.iter_layer_files(info):
+                if file_count == 0:
+                    print()
+                    display_heading(f"Scanning layer {info.diff_id}")
+                    scanned_layer_ids.add(info.diff_id)
+                file_count += 1
+                ui.increase_total(1)
+                if not _put_file(file_queue, scannable, stop_event):
+                    return
+    finally:
+        # Also end the queue if walking failed, so that the scan does not wait forever
+        _put_file(file_queue, None, stop_event)
+
+
+def _put_file(
+    file_queue: "queue.Queue[Optional[Scannable]]",
+    scannable: Optional[Scannable],
+    stop_event: threading.Event,
+) -> bool:
+    """
+    Pushes `scannable` to `file_queue`, unless `stop_event` gets set while waiting for
+    room in the queue. Returns True if `scannable` has been pushed.
+    """
+    while not stop_event.is_set():
+        try:
+            file_queue.put(scannable, timeout=QUEUE_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _scan_queue(
+    scanner: SecretScanner,
+    file_queue: "queue.Queue[Optional[Scannable]]",
+    ui: RichSecretScannerUI,
+    stop_event: threading.Event,
+) -> Results:
+    """
+    Scans the files of `file_queue`, in batches of at most SCAN_BATCH_SIZE files.
+    Sets `stop_event` when done, so that the walker stops if the scan stopped early.
+    """
+    results = Results(results=[], errors=[])
+    scannables = _iter_queue(file_queue)
+    try:
+        for first_scannable in scannables:
+            batch = itertools.chain(
+                [first_scannable], itertools.islice(scannables, SCAN_BATCH_SIZE - 1)
+            )
+            # The cache has been purged by the scan of the config: keep the secrets
+            # found by previous batches
+            results.extend(scanner.scan(batch, scanner_ui=ui, purge_cache=False))
+        return results
+    finally:
+        # If the scan stopped early (error, Ctrl-C...), the walker must not wait
+        # forever for room in the queue, nor walk the remaining layers
+        stop_event.set()
+
+
+def _iter_queue(
+    file_queue: "queue.Queue[Optional[Scannable]]",
+) -> Iterator[Scannable]:
+    while True:
+        scannable = file_queue.get()
+        if scannable is None:
+            return
+        yield scannable
+
+
 def _get_layer_id_cache(secrets_engine_version: str) -> IDCache:
     cache_path = Path(get_cache_dir()) / "docker" / f"{secrets_engine_version}.json"
     return IDCache(cache_path)
@@ -341,9 +568,9 @@ def docker_scan_archive(
     assert secrets_engine_version is not None
     layer_id_cache = _get_layer_id_cache(secrets_engine_version)
 
-    with tarfile.open(archive_path) as archive:
-        docker_image = DockerImage(archive)
-
+    with tarfile.open(archive_path) as archive, closing(
+        DockerImage(archive)
+    ) as docker_image:
         display_heading("Scanning Docker config")
         with RichSecretScannerUI(1) as ui:
             results = scanner.scan(
@@ -351,22 +578,59 @@ def docker_scan_archive(
                 scanner_ui=ui,
             )
 
+        layers_to_scan: List[LayerInfo] = []
         for info in docker_image.layer_infos:
-            layer = docker_image.get_layer(info)
-            file_count = len(layer.files)
-            if file_count == 0:
-                continue
-            print()
             layer_id = info.diff_id
             if layer_id in layer_id_cache:
+                print()
                 display_heading(f"Skipping layer {layer_id}: already scanned")
             else:
-                display_heading(f"Scanning layer {info.diff_id}")
-                with RichSecretScannerUI(file_count) as ui:
-                    layer_results = scanner.scan(layer.files, scanner_ui=ui)
-                if not layer_results.has_policy_breaks:
-                    layer_id_cache.add(layer_id)
-                results.extend(layer_results)
+                layers_to_scan.append(info)
+
+        if layers_to_scan:
+            # Files of all layers are scanned together, so that API requests are
+            # filled with files from several layers. Layers are walked by another
+            # thread, which feeds the scans through a bounded queue.
+            file_queue: "queue.Queue[Optional[Scannable]]" = queue.Queue(
+                maxsize=FILE_QUEUE_SIZE
+            )
+            scanned_layer_ids: Set[str] = set()
+            stop_event = threading.Event()
+            # The total is increased as files are found
+            with RichSecretScannerUI(0) as ui:
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="layer_walk"
+                ) as executor:
+                    walk_future = executor.submit(
+                        _walk_layers,
+                        docker_image,
+                        layers_to_scan,
+                        file_queue,
+                        ui,
+                        scanned_layer_ids,
+                        stop_event,
+                    )
+                    layer_results = _scan_queue(scanner, file_queue, ui, stop_event)
+            walk_future.result()
+
+            # Only cache layers which had files to scan and no policy breaks
+            layer_ids_with_policy_breaks = {
+                cast(DockerContentScannable, x.file).layer_id
+                for x in layer_results.results
+                if x.has_policy_breaks
+            }
+            for layer_id in scanned_layer_ids - layer_ids_with_policy_breaks:
+                layer_id_cache.add(layer_id)
+
+            # Scans of files from different layers complete in any order: report
+            # results in layer order
+            layer_indices = {x.diff_id: idx for idx, x in enumerate(layers_to_scan)}
+            layer_results.results.sort(
+                key=lambda x: layer_indices[
+                    cast(DockerContentScannable, x.file).layer_id
+                ]
+            )
+            results.extend(layer_results)
 
     return SecretScanCollection(
         id=str(archive), type="scan_docker_archive", results=results
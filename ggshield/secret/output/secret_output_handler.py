@@ -32,7 +32,7 @@ class SecretOutputHandler(ABC):
         """
         text = self._process_scan_impl(scan)
         if self.output:
-            with open(self.output, "w+") as f:
+            with open(self.output, "w", encoding="utf-8") as f:
                 f.write(text)
         else:
             click.echo(text)
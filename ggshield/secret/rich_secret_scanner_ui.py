@@ -17,6 +17,7 @@ class RichSecretScannerUI(SecretScannerUI):
     ):
         self.progress = create_progress_bar(scannable_type)
         task_title = f"Scanning {dataset_type}..." if dataset_type else "Scanning..."
+        self.total = total
         self.task = self.progress.add_task(task_title, total=total)
 
     def __enter__(self) -> "RichSecretScannerUI":
@@ -26,6 +27,14 @@ class RichSecretScannerUI(SecretScannerUI):
     def __exit__(self, *args: Any) -> None:
         self.progress.__exit__(*args)
 
+    def increase_total(self, count: int) -> None:
+        """
+        Increases the number of scannables to scan. Useful when scannables are
+        discovered while the scan is running.
+        """
+        self.total += count
+        self.progress.update(self.task, total=self.total)
+
     def on_scanned(self, scannables: Sequence[Scannable]) -> None:
         self.progress.advance(self.task, len(scannables))
 
@@ -94,11 +94,16 @@ class SecretScanner:
         files: Iterable[Scannable],
         scanner_ui: SecretScannerUI = DefaultSecretScannerUI(),
         scan_threads: int = 4,
+        purge_cache: bool = True,
     ) -> Results:
         """
         Starts the scan, using at most scan_threads.
         Reports progress through `scanner_ui`.
         Returns a Results instance.
+
+        Secrets found by previous scans are removed from the cache, unless
+        `purge_cache` is False. This lets callers scanning files in several calls
+        keep all the secrets they found.
         """
         logger.debug("files=%s command_id=%s", self, self.command_id)
 
@@ -111,7 +116,9 @@ class SecretScanner:
                 scanner_ui,
             )
 
-            return self._collect_results(scanner_ui, chunks_for_futures)
+            return self._collect_results(
+                scanner_ui, chunks_for_futures, purge_cache=purge_cache
+            )
 
     def _scan_chunk(
         self, executor: concurrent.futures.ThreadPoolExecutor, chunk: List[Scannable]
@@ -176,12 +183,14 @@ class SecretScanner:
         self,
         scanner_ui: SecretScannerUI,
         chunks_for_futures: Dict[Future, List[Scannable]],
+        purge_cache: bool = True,
     ) -> Results:
         """
         Receive scans as they complete, report progress and collect them and return
         a Results.
         """
-        self.cache.purge()
+        if purge_cache:
+            self.cache.purge()
 
         results = []
         errors = []
@@ -1,4 +1,6 @@
+import io
 import json
+import tarfile
 from pathlib import Path
 from unittest.mock import Mock, patch
 
@@ -7,9 +9,14 @@ import pytest
 
 from ggshield.cmd.main import cli
 from ggshield.core.errors import ExitCode
-from ggshield.scan import Files, StringScannable
+from ggshield.scan import StringScannable
 from ggshield.secret import SecretScanCollection
-from ggshield.secret.docker import DockerImage, LayerInfo, _validate_filepath
+from ggshield.secret.docker import (
+    DockerContentScannable,
+    DockerImage,
+    LayerInfo,
+    _validate_filepath,
+)
 from tests.unit.conftest import (
     DOCKER__INCOMPLETE_MANIFEST_EXAMPLE_PATH,
     DOCKER_EXAMPLE_PATH,
@@ -31,6 +38,9 @@ class TestDockerUtils:
             ["/usr/share/nginx/secret.py", True],
             ["/gems/secret.py", True],
             ["/npm-bis/secret.py", True],
+            ["var/secret.py", False],
+            ["/site-packages/foo/secret.py", False],
+            ["/lib64/secret.py", True],
             ["/banned/extension/secret.exe", False],
             ["/banned/extension/secret.mng", False],
             ["/banned/extension/secret.tar", False],
@@ -110,7 +120,10 @@ class TestDockerCMD:
         assert image_path.exists()
 
         layer_info = LayerInfo(
-            filename="12345678/layer.tar", command="COPY foo", diff_id="sha256:1234"
+            filename="12345678/layer.tar",
+            command="COPY foo",
+            diff_id="sha256:1234",
+            tar_info=tarfile.TarInfo("12345678/layer.tar"),
         )
 
         def create_docker_image() -> Mock(spec=DockerImage):
@@ -120,10 +133,15 @@ class TestDockerCMD:
             )
             docker_image.layer_infos = [layer_info]
 
-            scannable = StringScannable(
-                content=UNCHECKED_SECRET_PATCH, url="file_secret"
+            content = UNCHECKED_SECRET_PATCH.encode()
+            tar_info = tarfile.TarInfo("file_secret")
+            tar_info.size = len(content)
+            layer_archives = Mock()
+            layer_archives.extractfile.side_effect = lambda *args: io.BytesIO(content)
+            scannable = DockerContentScannable(
+                layer_info.diff_id, layer_archives, layer_info.tar_info, tar_info
             )
-            docker_image.get_layer.return_value = Files([scannable])
+            docker_image.iter_layer_files.return_value = iter([scannable])
 
             return docker_image
 
@@ -146,7 +164,7 @@ class TestDockerCMD:
                 ],
             )
             assert_invoke_exited_with(result, ExitCode.SCAN_FOUND_PROBLEMS)
-            docker_image.get_layer.assert_called_once_with(layer_info)
+            docker_image.iter_layer_files.assert_called_once_with(layer_info)
 
             if json_output:
                 output = json.loads(result.output)
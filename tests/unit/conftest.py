@@ -582,8 +582,13 @@ DOCKER_EXAMPLE_LAYER_FILES = {
 }
 
 
+# Computed once: isolated_fs() needs these paths for every test using it
+CASSETTES_DIR = join(dirname(realpath(__file__)), "cassettes")
+CA_BUNDLE_DIR = os.path.dirname(extract_zipped_paths(DEFAULT_CA_BUNDLE_PATH))
+
+
 my_vcr = vcr.VCR(
-    cassette_library_dir=join(dirname(realpath(__file__)), "cassettes"),
+    cassette_library_dir=CASSETTES_DIR,
     path_transformer=vcr.VCR.ensure_suffix(".yaml"),
     decode_compressed_response=True,
     ignore_localhost=True,
@@ -627,10 +632,9 @@ def cli_fs_runner(cli_runner):
 @pytest.fixture(scope="function")
 def isolated_fs(fs):
     # isolate fs but include CA bundle for https validation
-    fs.add_real_directory(os.path.dirname(extract_zipped_paths(DEFAULT_CA_BUNDLE_PATH)))
+    fs.add_real_directory(CA_BUNDLE_DIR)
     # add cassettes dir
-    cassettes_dir = join(dirname(realpath(__file__)), "cassettes")
-    fs.add_real_directory(cassettes_dir)
+    fs.add_real_directory(CASSETTES_DIR)
     # Add a fake OS-release file. It describes a linux OS
     mock_contents = """ID="ubuntu"\nVERSION_ID="22.04"\n"""
     f = fs.create_file("/etc/os-release")
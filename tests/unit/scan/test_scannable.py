@@ -1,6 +1,10 @@
+from io import BytesIO
 from pathlib import Path
+from unittest.mock import patch
 
-from ggshield.scan import Files, StringScannable
+import pytest
+
+from ggshield.scan import Files, Scannable, StringScannable
 
 
 def test_apply_filter():
@@ -21,3 +25,26 @@ def test_string_scannable_path():
     """
     scannable = StringScannable(url="custom:/some/path", content="")
     assert scannable.path == Path("/some/path")
+
+
+@pytest.mark.parametrize(
+    ("content", "size", "expected_result"),
+    [
+        ("x" * 100, 50, (True, None)),
+        ("x" * 100, 200, (False, "x" * 100)),
+        ("", 50, (False, "")),
+        ("x", 0, (True, None)),
+        ("", 0, (False, "")),
+    ],
+)
+def test_is_file_longer_than_reads_file_once(content, size, expected_result):
+    """
+    GIVEN a file object
+    WHEN _is_file_longer_than() is called on it
+    THEN it returns the right value
+    AND it reads the file only once
+    """
+    fp = BytesIO(content.encode())
+    with patch.object(fp, "seek", wraps=fp.seek) as seek_mock:
+        assert Scannable._is_file_longer_than(fp, size) == expected_result
+    seek_mock.assert_not_called()
@@ -1,20 +1,41 @@
+import io
+import json
+import queue
 import re
 import subprocess
 import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
-from typing import Dict
-from unittest.mock import patch
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from unittest.mock import Mock, patch
 
 import click
 import pytest
+from pygitguardian.models import Match, MultiScanResult, PolicyBreak, ScanResult
 
+from ggshield.core.cache import Cache
 from ggshield.core.errors import UnexpectedError
+from ggshield.scan import ScanContext, ScanMode, Scannable, StringScannable
+from ggshield.scan.id_cache import IDCache
 from ggshield.secret.docker import (
+    DockerContentScannable,
     DockerImage,
     InvalidDockerArchiveException,
     LayerInfo,
+    _iter_tar_members,
+    _scan_queue,
+    _should_scan_layer_command,
+    _walk_layers,
     docker_pull_image,
     docker_save_to_tmp,
+    docker_scan_archive,
+)
+from ggshield.secret.secret_scan_collection import (
+    Result,
+    Results,
+    SecretScanCollection,
 )
 from tests.unit.conftest import (
     DOCKER__INCOMPLETE_MANIFEST_EXAMPLE_PATH,
@@ -41,6 +62,78 @@ class TarMock:
         return member if self.members.get(member, None) else None
 
 
+def _make_tar_member(name: str, data: bytes) -> Tuple[tarfile.TarInfo, bytes]:
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(data)
+    return tar_info, data
+
+
+def _add_tar_member(
+    archive: tarfile.TarFile, tar_info: tarfile.TarInfo, data: bytes
+) -> None:
+    archive.addfile(tar_info, io.BytesIO(data))
+
+
+def _make_layer_archive(files: Dict[str, bytes]) -> bytes:
+    fp = io.BytesIO()
+    with tarfile.open(fileobj=fp, mode="w") as archive:
+        for name, data in files.items():
+            _add_tar_member(archive, *_make_tar_member(name, data))
+    return fp.getvalue()
+
+
+def _write_image_archive(
+    path: Path, layer_members: List[Tuple[tarfile.TarInfo, bytes]]
+) -> None:
+    """
+    Writes an image archive whose layers are `layer_members`, all created by COPY
+    commands
+    """
+    manifest = [{"Config": "config.json", "Layers": [x.name for x, _ in layer_members]}]
+    config = {
+        "history": [{"created_by": "COPY . / # buildkit"} for _ in layer_members],
+        "rootfs": {"diff_ids": [f"sha256:{idx}" for idx in range(len(layer_members))]},
+    }
+    with tarfile.open(path, "w") as archive:
+        for name, document in (("manifest.json", manifest), ("config.json", config)):
+            _add_tar_member(
+                archive, *_make_tar_member(name, json.dumps(document).encode())
+            )
+        for tar_info, data in layer_members:
+            _add_tar_member(archive, tar_info, data)
+
+
+@pytest.fixture
+def layer_id_cache(tmp_path: Path) -> Iterator[IDCache]:
+    """
+    Makes docker_scan_archive() use an empty layer cache
+    """
+    cache = IDCache(tmp_path / "layers.json")
+    with patch("ggshield.secret.docker._get_layer_id_cache", return_value=cache):
+        yield cache
+
+
+@pytest.fixture
+def scanner_mock() -> Iterator[Mock]:
+    """
+    Replaces the SecretScanner used by docker_scan_archive() with a mock
+    """
+    with patch("ggshield.secret.docker.SecretScanner") as scanner_cls_mock:
+        yield scanner_cls_mock.return_value
+
+
+def _scan_example_image(
+    client: Optional[Mock] = None, cache: Optional[Cache] = None
+) -> SecretScanCollection:
+    return docker_scan_archive(
+        archive_path=DOCKER_EXAMPLE_PATH,
+        client=client or Mock(secrets_engine_version="1.0"),
+        cache=cache or Mock(),
+        matches_ignore=[],
+        scan_context=ScanContext(scan_mode=ScanMode.DOCKER, command_path="ggshield"),
+    )
+
+
 class TestDockerScan:
     @pytest.mark.parametrize(
         ["op", "want"],
@@ -54,11 +147,13 @@ class TestDockerScan:
                 '/bin/sh -c #(nop)  CMD ["/usr/bin/bash"',
                 False,
             ),
+            pytest.param("COPY foo.conf /etc/foo.conf # buildkit", True),
+            pytest.param("ADD\tfoo.tar.gz / # buildkit", True),
+            pytest.param("RUN /bin/sh -c apt-get install -y curl # buildkit", False),
         ],
     )
     def test_should_scan_layer(self, op: str, want: bool):
-        layer_info = LayerInfo(filename="dummy", command=op, diff_id="sha256:1234")
-        assert layer_info.should_scan() is want
+        assert _should_scan_layer_command(op) is want
 
     @pytest.mark.parametrize(
         ["members", "match"],
@@ -82,31 +177,347 @@ class TestDockerScan:
         with pytest.raises(InvalidDockerArchiveException, match=match):
             DockerImage(tarfile)
 
+    def test_docker_config_scannable(self):
+        """
+        GIVEN a Docker image archive
+        WHEN its config scannable is created
+        THEN it contains the image config, one value per line, without indentation
+        """
+        with tarfile.open(DOCKER_EXAMPLE_PATH) as archive:
+            image = DockerImage(archive)
+
+        content = image.config_scannable.content
+        assert json.loads(content) == image.image
+        lines = content.splitlines()
+        assert len(lines) > 1
+        assert not any(line.startswith(" ") for line in lines)
+
     @pytest.mark.parametrize(
         "image_path", [DOCKER_EXAMPLE_PATH, DOCKER__INCOMPLETE_MANIFEST_EXAMPLE_PATH]
     )
     def test_docker_archive(self, image_path: Path):
-        with tarfile.open(image_path) as archive:
-            image = DockerImage(archive)
+        with tarfile.open(image_path) as archive, closing(
+            DockerImage(archive)
+        ) as image:
+            # Maps layer IDs to the content of their files, skipping layers with no
+            # scannables
+            content_dicts = {}
+            for layer_info in image.layer_infos:
+                content_dict = {
+                    x.path.as_posix(): x.content
+                    for x in image.iter_layer_files(layer_info)
+                }
+                if content_dict:
+                    content_dicts[layer_info.diff_id] = content_dict
 
-            # List of (LayerInfo, Files)
-            # The filter is here to remove layers with no scannables
-            infos_and_layers = list(
-                filter(
-                    lambda info_and_layer: info_and_layer[1].files,
-                    ((x, image.get_layer(x)) for x in image.layer_infos),
-                )
+        assert content_dicts == DOCKER_EXAMPLE_LAYER_FILES
+        assert list(content_dicts) == list(DOCKER_EXAMPLE_LAYER_FILES)
+
+    def test_iter_layer_files_does_not_open_empty_layer_archive(self, tmp_path: Path):
+        """
+        GIVEN an image archive whose layer archive only contains the end-of-archive
+        marker
+        WHEN iter_layer_files() is called on the layer
+        THEN it yields nothing
+        AND the layer archive is not opened
+        """
+        archive_path = tmp_path / "image.tar"
+        _write_image_archive(
+            archive_path, [_make_tar_member("layer/layer.tar", b"\0" * 1024)]
+        )
+
+        with tarfile.open(archive_path) as archive, closing(
+            DockerImage(archive)
+        ) as image:
+            (layer_info,) = image.layer_infos
+            with patch.object(
+                archive, "extractfile", wraps=archive.extractfile
+            ) as extractfile_mock:
+                assert list(image.iter_layer_files(layer_info)) == []
+            extractfile_mock.assert_not_called()
+
+    def test_iter_layer_files_follows_linked_layer_archive(self, tmp_path: Path):
+        """
+        GIVEN an image archive where a layer archive is a symlink to another one, as
+        created by older versions of `docker save`
+        WHEN iter_layer_files() is called on the linked layer
+        THEN it yields the files of the target layer archive
+        """
+        archive_path = tmp_path / "image.tar"
+        link_info = tarfile.TarInfo("layer2/layer.tar")
+        link_info.type = tarfile.SYMTYPE
+        link_info.linkname = "../layer1/layer.tar"
+        layer_data = _make_layer_archive({"app/file.conf": b"password=1234"})
+        _write_image_archive(
+            archive_path,
+            [_make_tar_member("layer1/layer.tar", layer_data), (link_info, b"")],
+        )
+
+        with tarfile.open(archive_path) as archive, closing(
+            DockerImage(archive)
+        ) as image:
+            link_layer_info = image.layer_infos[1]
+            files = list(image.iter_layer_files(link_layer_info))
+            assert [(x.path.as_posix(), x.content) for x in files] == [
+                ("/app/file.conf", "password=1234")
+            ]
+
+    def test_docker_scan_archive_scans_layer_files(
+        self, scanner_mock: Mock, layer_id_cache: IDCache
+    ):
+        """
+        GIVEN a Docker image archive
+        WHEN it is scanned
+        THEN the config and all the files of its layers are scanned
+        """
+        scanned_paths: List[str] = []
+
+        def scan(files: Iterable[Scannable], **kwargs) -> Results:
+            for file in files:
+                assert file.content
+                scanned_paths.append(file.path.as_posix())
+            return Results(results=[], errors=[])
+
+        scanner_mock.scan.side_effect = scan
+
+        _scan_example_image()
+
+        expected_paths = [
+            path
+            for layer_dict in DOCKER_EXAMPLE_LAYER_FILES.values()
+            for path in layer_dict
+        ]
+        assert sorted(scanned_paths) == sorted(
+            ["Dockerfile or build-args"] + expected_paths
+        )
+
+    def test_docker_scan_archive_caches_layers_without_policy_breaks(
+        self, scanner_mock: Mock, layer_id_cache: IDCache
+    ):
+        """
+        GIVEN a Docker image archive with a policy break in its last layer
+        WHEN it is scanned
+        THEN only the other layers are added to the layer cache
+        """
+        clean_layer_id, leaking_layer_id = DOCKER_EXAMPLE_LAYER_FILES
+
+        def scan(files: Iterable[Scannable], **kwargs) -> Results:
+            scan_result = Mock(has_policy_breaks=True, policy_breaks=[])
+            results = [
+                Result(file=x, scan=scan_result)
+                for x in files
+                if isinstance(x, DockerContentScannable)
+                and x.layer_id == leaking_layer_id
+            ]
+            return Results(results=results, errors=[])
+
+        scanner_mock.scan.side_effect = scan
+
+        _scan_example_image()
+
+        assert clean_layer_id in layer_id_cache
+        assert leaking_layer_id not in layer_id_cache
+
+    def test_docker_scan_archive_reports_results_in_layer_order(
+        self, scanner_mock: Mock, layer_id_cache: IDCache
+    ):
+        """
+        GIVEN a Docker image archive with policy breaks in several layers
+        WHEN the scans of the last layers complete first
+        THEN results are reported in layer order
+        """
+
+        def scan(files: Iterable[Scannable], **kwargs) -> Results:
+            scan_result = Mock(has_policy_breaks=True, policy_breaks=[])
+            results = [Result(file=x, scan=scan_result) for x in files]
+            return Results(results=results[::-1], errors=[])
+
+        scanner_mock.scan.side_effect = scan
+
+        collection = _scan_example_image()
+
+        layer_ids = [x.file.layer_id for x in collection.results.results[1:]]
+        assert layer_ids == sorted(
+            layer_ids, key=list(DOCKER_EXAMPLE_LAYER_FILES).index
+        )
+        assert len(set(layer_ids)) == len(DOCKER_EXAMPLE_LAYER_FILES)
+
+    @patch("ggshield.secret.docker.SCAN_BATCH_SIZE", 1)
+    def test_docker_scan_archive_scans_in_batches(
+        self, scanner_mock: Mock, layer_id_cache: IDCache
+    ):
+        """
+        GIVEN a Docker image archive
+        WHEN it is scanned
+        THEN layer files are scanned in batches of at most SCAN_BATCH_SIZE files
+        """
+        batch_sizes: List[int] = []
+
+        def scan(files: Iterable[Scannable], **kwargs) -> Results:
+            batch_sizes.append(len(list(files)))
+            return Results(results=[], errors=[])
+
+        scanner_mock.scan.side_effect = scan
+
+        _scan_example_image()
+
+        file_count = sum(len(x) for x in DOCKER_EXAMPLE_LAYER_FILES.values())
+        # One batch for the config, then one batch per layer file
+        assert batch_sizes == [1] * (1 + file_count)
+
+    @patch("ggshield.secret.docker.SCAN_BATCH_SIZE", 1)
+    def test_docker_scan_archive_keeps_secrets_of_all_batches(
+        self, layer_id_cache: IDCache, tmp_path: Path
+    ):
+        """
+        GIVEN a Docker image archive whose files all contain a secret
+        WHEN its layer files are scanned in several batches
+        THEN the secrets found in every batch are kept in the cache
+        """
+
+        def multi_content_scan(documents: List[Dict[str, str]], *args, **kwargs):
+            result = MultiScanResult(
+                [
+                    ScanResult(
+                        policy_break_count=1,
+                        policy_breaks=[
+                            PolicyBreak(
+                                "apikey",
+                                "Secrets detection",
+                                "valid",
+                                [Match(x["document"], "apikey")],
+                            )
+                        ],
+                        policies=[],
+                    )
+                    for x in documents
+                ]
             )
+            result.status_code = 200
+            return result
 
-            layer_ids = [x.diff_id for x, _ in infos_and_layers]
-            assert layer_ids == list(DOCKER_EXAMPLE_LAYER_FILES)
+        client = Mock(secrets_engine_version="1.0")
+        client.multi_content_scan.side_effect = multi_content_scan
+        cache = Cache(str(tmp_path / ".cache_ggshield"))
 
-            layers = [l for _, l in infos_and_layers]
-            for layer, expected_content_dict in zip(
-                layers, DOCKER_EXAMPLE_LAYER_FILES.values()
-            ):
-                content_dict = {x.path.as_posix(): x.content for x in layer.files}
-                assert content_dict == expected_content_dict
+        _scan_example_image(client=client, cache=cache)
+
+        file_count = sum(len(x) for x in DOCKER_EXAMPLE_LAYER_FILES.values())
+        # One secret for the config, one for each layer file
+        assert len(cache.last_found_secrets) == 1 + file_count
+
+    def test_docker_scan_archive_skips_cached_layers(
+        self, scanner_mock: Mock, layer_id_cache: IDCache
+    ):
+        """
+        GIVEN a Docker image archive whose first layer is in the layer cache
+        WHEN it is scanned
+        THEN the archive of the cached layer is not walked
+        """
+        scanner_mock.scan.return_value = Results(results=[], errors=[])
+        cached_layer_id, scanned_layer_id = DOCKER_EXAMPLE_LAYER_FILES
+        layer_id_cache.add(cached_layer_id)
+
+        with patch.object(
+            DockerImage,
+            "iter_layer_files",
+            autospec=True,
+            side_effect=DockerImage.iter_layer_files,
+        ) as iter_layer_files_mock:
+            _scan_example_image()
+
+        walked_layer_ids = [
+            call.args[1].diff_id for call in iter_layer_files_mock.call_args_list
+        ]
+        assert cached_layer_id not in walked_layer_ids
+        assert scanned_layer_id in walked_layer_ids
+
+    def test_walker_stops_when_scan_fails(self):
+        """
+        GIVEN a layer walker feeding a queue faster than it is scanned
+        WHEN the scan of the queue fails
+        THEN the walker stops without walking the remaining files
+        """
+        walked_count = 0
+
+        def iter_layer_files(layer_info: LayerInfo) -> Iterable[Scannable]:
+            nonlocal walked_count
+            for idx in range(1000):
+                walked_count += 1
+                yield StringScannable(url=f"file{idx}", content="x")
+
+        def scan(files: Iterable[Scannable], **kwargs) -> Results:
+            next(iter(files))
+            raise click.UsageError("Invalid API key.")
+
+        docker_image = Mock(spec=DockerImage)
+        docker_image.iter_layer_files.side_effect = iter_layer_files
+        scanner = Mock()
+        scanner.scan.side_effect = scan
+        layer_info = LayerInfo(
+            filename="layer.tar",
+            command="COPY . /",
+            diff_id="sha256:1234",
+            tar_info=tarfile.TarInfo("layer.tar"),
+        )
+        file_queue: "queue.Queue[Scannable]" = queue.Queue(maxsize=2)
+        stop_event = threading.Event()
+        ui = Mock()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            walk_future = executor.submit(
+                _walk_layers,
+                docker_image,
+                [layer_info],
+                file_queue,
+                ui,
+                set(),
+                stop_event,
+            )
+            with pytest.raises(click.UsageError):
+                _scan_queue(scanner, file_queue, ui, stop_event)
+            walk_future.result(timeout=5)
+
+        assert walked_count < 10
+
+    @pytest.mark.parametrize(
+        ("byte_size", "expected"), [(10, False), (4 * 100 + 5, True)]
+    )
+    def test_docker_content_scannable_is_longer_than_does_not_read(
+        self, byte_size: int, expected: bool
+    ):
+        """
+        GIVEN a DockerContentScannable whose byte size is much smaller or much bigger
+        than the requested size
+        WHEN is_longer_than() is called on it
+        THEN it returns the right value without reading the file
+        """
+        layer_archives = Mock()
+        tar_info = tarfile.TarInfo("app/file")
+        tar_info.size = byte_size
+        scannable = DockerContentScannable(
+            "sha256:1234", layer_archives, tarfile.TarInfo("layer.tar"), tar_info
+        )
+
+        assert scannable.is_longer_than(100) is expected
+        layer_archives.extractfile.assert_not_called()
+
+    def test_iter_tar_members_does_not_keep_members(self, tmp_path: Path):
+        """
+        GIVEN a tar archive
+        WHEN _iter_tar_members() is called on it
+        THEN it yields all the members of the archive
+        AND the TarFile does not keep them in memory
+        """
+        archive_path = tmp_path / "archive.tar"
+        names = [f"file{i}" for i in range(3)]
+        with tarfile.open(archive_path, "w") as archive:
+            for name in names:
+                archive.addfile(tarfile.TarInfo(name))
+
+        with tarfile.open(archive_path) as archive:
+            assert [x.name for x in _iter_tar_members(archive)] == names
+            assert archive.members == []
 
 
 DOCKER_TIMEOUT = 12